@@ -3,12 +3,53 @@
 
 """
 Functions to calculate distances relative to the grid.
+
+If numexpr is installed, haversine expressions are evaluated in a single
+fused pass without intermediate arrays; otherwise numpy is used. If cupy is
+installed, distance matrices can also be computed on a CUDA GPU, and if numba
+is installed, nearest distances are computed without the distance matrix.
 """
 
 import numpy as np
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 
-def dmat(lons1, lats1, lons2, lats2, R=6371.007):
+# CUDA haversine kernel with one thread per element of the distance matrix
+_HAVERSINE_SRC = r'''
+extern "C" __global__
+void haversine(const double* lons1, const double* lats1, const double* cos_lats1,
+               const double* lons2, const double* lats2, const double* cos_lats2,
+               const long long n, const long long m, const double R,
+               double* out)
+{
+    long long k = (long long)blockDim.x * blockIdx.x + threadIdx.x;
+    if (k >= n*m) return;
+    long long i = k / m, j = k % m;
+    double sin_dlat = sin(0.5*(lats1[i] - lats2[j]));
+    double sin_dlon = sin(0.5*(lons1[i] - lons2[j]));
+    double a = sin_dlat*sin_dlat + cos_lats1[i]*cos_lats2[j]*sin_dlon*sin_dlon;
+    out[k] = 2.0*R*asin(sqrt(a));
+}
+'''
+_haversine_kernel = (cp.RawKernel(_HAVERSINE_SRC, 'haversine')
+                     if cp is not None else None)
+
+
+def dmat(lons1, lats1, lons2, lats2, R=6371.007, block=1024):
     """Great circle (haversine) distance matrix in km from two different
     pairs of lon, lat arrays. Assumes both arrays in decimal degrees.
 
@@ -28,6 +69,9 @@ def dmat(lons1, lats1, lons2, lats2, R=6371.007):
             Latitudes in decimal degrees.
         R : float
             Earth's radius in km.
+        block : int, optional
+            Number of rows of the distance matrix computed at a time when
+            numexpr is not available.
 
     Returns
     -------
@@ -37,10 +81,355 @@ def dmat(lons1, lats1, lons2, lats2, R=6371.007):
 
     lons1_rad, lats1_rad = np.deg2rad(lons1), np.deg2rad(lats1)
     lons2_rad, lats2_rad = np.deg2rad(lons2), np.deg2rad(lats2)
-    
-    dlon = lons1_rad[:, None] - lons2_rad
-    dlat = lats1_rad[:, None] - lats2_rad
 
-    d = (np.sin(dlat/2)**2 + np.cos(lats1_rad[:, None]) * 
-         np.cos(lats2_rad) * np.sin(dlon/2)**2)
-    return 2*R*np.arcsin(np.sqrt(d))
+    # Evaluate the broadcast expression in cache-sized blocks with numexpr
+    if ne is not None:
+        cos_lats1, cos_lats2 = np.cos(lats1_rad)[:, None], np.cos(lats2_rad)
+        lons1_rad, lats1_rad = lons1_rad[:, None], lats1_rad[:, None]
+        return ne.evaluate('2*R*arcsin(sqrt(sin((lats1_rad-lats2_rad)*0.5)**2 + '
+                           'cos_lats1*cos_lats2*'
+                           'sin((lons1_rad-lons2_rad)*0.5)**2))')
+
+    # Otherwise fill the matrix in blocks of rows, writing intermediate
+    # results into the output and a single block-sized buffer
+    lons2_rad, lats2_rad = np.atleast_1d(lons2_rad), np.atleast_1d(lats2_rad)
+    cos_lats1, cos_lats2 = np.cos(lats1_rad), np.cos(lats2_rad)
+    out = np.empty((lons1_rad.size, lons2_rad.size))
+    buf = np.empty((min(block, lons1_rad.size), lons2_rad.size))
+
+    for i0 in range(0, lons1_rad.size, block):
+        sl = slice(i0, i0+block)
+        d = out[sl]
+        t = buf[:d.shape[0]]
+        np.subtract(lats1_rad[sl, None], lats2_rad, out=d)
+        d *= 0.5
+        np.sin(d, out=d)
+        d *= d
+        np.subtract(lons1_rad[sl, None], lons2_rad, out=t)
+        t *= 0.5
+        np.sin(t, out=t)
+        t *= t
+        t *= cos_lats1[sl, None]
+        t *= cos_lats2
+        d += t
+        np.sqrt(d, out=d)
+        np.arcsin(d, out=d)
+        d *= 2*R
+    return out
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True,
+          fastmath={'contract', 'arcp', 'reassoc'})
+    def _dmat_min_kernel(lons1, lats1, cos_lats1, lons2, lats2, cos_lats2, R):
+        """Numba kernel for dmat_min, with coordinates in radians."""
+
+        out = np.empty(lons1.size)
+        for i in prange(lons1.size):
+            # The haversine term is monotonic in distance, so minimise that.
+            # It is at most 1, so start above it, and propagate NaNs as the
+            # numpy fallback does
+            best = 2.0
+            for j in range(lons2.size):
+                sin_dlat = np.sin((lats1[i] - lats2[j])*0.5)
+                sin_dlon = np.sin((lons1[i] - lons2[j])*0.5)
+                a = sin_dlat**2 + cos_lats1[i]*cos_lats2[j]*sin_dlon**2
+                if a < best:
+                    best = a
+                elif np.isnan(a):
+                    best = a
+                    break
+            out[i] = 2*R*np.arcsin(np.sqrt(best))
+        return out
+else:
+    _dmat_min_kernel = None
+
+
+def dmat_min(lons1, lats1, lons2, lats2, R=6371.007, block=1024):
+    """Great circle (haversine) distance in km from each point in the first
+    pair of lon, lat arrays to the nearest point in the second pair. This is
+    equivalent to dmat(...).min(axis=1) without the full distance matrix.
+    Assumes both arrays in decimal degrees.
+
+    Parameters
+    ----------
+        lons1 : numpy array
+            Longitudes in decimal degrees.
+        lats1 : numpy array
+            Latitudes in decimal degrees.
+        lons2 : numpy array
+            Longitudes in decimal degrees.
+        lats2 : numpy array
+            Latitudes in decimal degrees.
+        R : float
+            Earth's radius in km.
+        block : int, optional
+            Number of rows of the distance matrix computed at a time when
+            numba is not available.
+
+    Returns
+    -------
+        dmin : numpy array
+            Distances in km to the nearest point.
+    """
+
+    lons1 = np.asarray(lons1, dtype=np.float64).ravel()
+    lats1 = np.asarray(lats1, dtype=np.float64).ravel()
+    lons2 = np.asarray(lons2, dtype=np.float64).ravel()
+    lats2 = np.asarray(lats2, dtype=np.float64).ravel()
+    if lons2.size == 0:
+        raise ValueError('dmat_min needs at least one point in lons2, lats2')
+
+    if _dmat_min_kernel is not None:
+        lons1_rad, lats1_rad = np.deg2rad(lons1), np.deg2rad(lats1)
+        lons2_rad, lats2_rad = np.deg2rad(lons2), np.deg2rad(lats2)
+        return _dmat_min_kernel(lons1_rad, lats1_rad, np.cos(lats1_rad),
+                                lons2_rad, lats2_rad, np.cos(lats2_rad), R)
+
+    # Otherwise reduce the distance matrix one block of rows at a time
+    out = np.empty(lons1.size)
+    for i0 in range(0, lons1.size, block):
+        sl = slice(i0, i0+block)
+        out[sl] = dmat(lons1[sl], lats1[sl], lons2, lats2, R).min(axis=1)
+    return out
+
+
+def dmat_point(lons, lats, lon, lat, R=6371.007):
+    """Great circle (haversine) distances in km from arrays of lons and lats
+    to a single point. Assumes all coordinates in decimal degrees.
+
+    Parameters
+    ----------
+        lons : numpy array
+            Longitudes in decimal degrees.
+        lats : numpy array
+            Latitudes in decimal degrees.
+        lon : float
+            Longitude of point in decimal degrees.
+        lat : float
+            Latitude of point in decimal degrees.
+        R : float
+            Earth's radius in km.
+
+    Returns
+    -------
+        d : numpy array
+            Distances in km, with the same shape as lons and lats.
+    """
+
+    lons_rad = np.deg2rad(np.asarray(lons, dtype=np.float64))
+    lats_rad = np.deg2rad(np.asarray(lats, dtype=np.float64))
+    return dmat_cached(lons_rad, lats_rad, np.cos(lats_rad), lon, lat, R)
+
+
+def dmat_cached(lons_rad, lats_rad, cos_lats, lon, lat, R=6371.007):
+    """Great circle (haversine) distances in km from arrays of lons and lats
+    to a single point, where the array coordinates have been converted to
+    radians and their latitude cosines precomputed.
+
+    Parameters
+    ----------
+        lons_rad : numpy array
+            Longitudes in radians.
+        lats_rad : numpy array
+            Latitudes in radians.
+        cos_lats : numpy array
+            Cosines of lats_rad.
+        lon : float
+            Longitude of point in decimal degrees.
+        lat : float
+            Latitude of point in decimal degrees.
+        R : float
+            Earth's radius in km.
+
+    Returns
+    -------
+        d : numpy array
+            Distances in km, with the same shape as lons_rad and lats_rad.
+    """
+
+    # Accept scalars as well as 1-element arrays for the point
+    lon_rad = np.deg2rad(np.asarray(lon, dtype=np.float64).squeeze())
+    lat_rad = np.deg2rad(np.asarray(lat, dtype=np.float64).squeeze())
+    cos_lat = np.cos(lat_rad)
+
+    if ne is not None:
+        return ne.evaluate('2*R*arcsin(sqrt(sin((lats_rad-lat_rad)*0.5)**2 + '
+                           'cos_lats*cos_lat*sin((lons_rad-lon_rad)*0.5)**2))')
+
+    # Fall back to numpy, reusing two buffers for all intermediate results
+    d = lats_rad - lat_rad
+    d *= 0.5
+    np.sin(d, out=d)
+    d *= d
+    t = lons_rad - lon_rad
+    t *= 0.5
+    np.sin(t, out=t)
+    t *= t
+    t *= cos_lat
+    t *= cos_lats
+    d += t
+    np.sqrt(d, out=d)
+    np.arcsin(d, out=d)
+    d *= 2*R
+    return d
+
+
+def dmat_mas(lons_mas, lats_mas, cos_lats, lon_mas, lat_mas, R=6371.007):
+    """Single precision great circle (haversine) distances in km from arrays
+    of lons and lats to a single point, all in integer milliarcseconds, where
+    the float32 latitude cosines of the arrays have been precomputed.
+
+    Coordinate differences are taken exactly in integers and cast straight
+    to float32, and only the trigonometry is done in float32, giving relative
+    errors below 1e-4.
+
+    Parameters
+    ----------
+        lons_mas : numpy array
+            Longitudes in milliarcseconds.
+        lats_mas : numpy array
+            Latitudes in milliarcseconds.
+        cos_lats : numpy array
+            float32 cosines of lats_mas.
+        lon_mas : int
+            Longitude of point in milliarcseconds.
+        lat_mas : int
+            Latitude of point in milliarcseconds.
+        R : float
+            Earth's radius in km.
+
+    Returns
+    -------
+        d : numpy array
+            float32 distances in km, with the same shape as lons_mas.
+    """
+
+    mas2rad = np.pi/(180*3_600_000)
+    half = np.float32(0.5*mas2rad)
+    lon_mas, lat_mas = np.int64(lon_mas), np.int64(lat_mas)
+    cos_lat = np.float32(np.cos(lat_mas*mas2rad))
+    two_R = np.float32(2*R)
+
+    if ne is not None:
+        return ne.evaluate('two_R*arcsin(sqrt('
+                           'sin((lats_mas-lat_mas)*half)**2 + cos_lats*cos_lat'
+                           '*sin((lons_mas-lon_mas)*half)**2))')
+
+    # Fall back to numpy, casting the integer differences to float32 as they
+    # are written, then reusing the two float32 buffers
+    dlon = np.empty(lons_mas.shape, dtype=np.float32)
+    dlat = np.empty(lats_mas.shape, dtype=np.float32)
+    np.subtract(lons_mas, lon_mas, out=dlon, casting='unsafe')
+    np.subtract(lats_mas, lat_mas, out=dlat, casting='unsafe')
+    dlat *= half
+    np.sin(dlat, out=dlat)
+    dlat *= dlat
+    dlon *= half
+    np.sin(dlon, out=dlon)
+    dlon *= dlon
+    dlon *= cos_lat
+    dlon *= cos_lats
+    dlat += dlon
+    np.sqrt(dlat, out=dlat)
+    np.arcsin(dlat, out=dlat)
+    dlat *= two_R
+    return dlat
+
+
+def dmat_gpu(lons1, lats1, lons2, lats2, R=6371.007, asnumpy=True):
+    """Great circle (haversine) distance matrix in km computed on the GPU.
+    Inputs may be numpy or cupy arrays in decimal degrees; arrays already on
+    the device are not copied. Falls back to dmat if cupy is not installed.
+
+    Parameters
+    ----------
+        lons1 : numpy or cupy array
+            Longitudes in decimal degrees.
+        lats1 : numpy or cupy array
+            Latitudes in decimal degrees.
+        lons2 : numpy or cupy array
+            Longitudes in decimal degrees.
+        lats2 : numpy or cupy array
+            Latitudes in decimal degrees.
+        R : float
+            Earth's radius in km.
+        asnumpy : bool, optional
+            Copy the result back to the host. If False, a cupy array is
+            returned which stays on the device for further processing.
+
+    Returns
+    -------
+        dmat : numpy or cupy array
+            Distance matrix in km.
+    """
+
+    if cp is None:
+        return dmat(lons1, lats1, lons2, lats2, R)
+
+    lons1_rad, lats1_rad, lons2_rad, lats2_rad = (
+        cp.deg2rad(cp.asarray(x, dtype=cp.float64).ravel())
+        for x in (lons1, lats1, lons2, lats2))
+    out = _haversine_gpu(lons1_rad, lats1_rad, cp.cos(lats1_rad),
+                         lons2_rad, lats2_rad, cp.cos(lats2_rad), R)
+    return cp.asnumpy(out) if asnumpy else out
+
+
+def dmat_gpu_cached(lons_rad, lats_rad, cos_lats, lon, lat, R=6371.007,
+                    asnumpy=True):
+    """Great circle (haversine) distances in km computed on the GPU from
+    arrays of lons and lats to a single point, where the array coordinates
+    are already on the device in radians with their latitude cosines
+    precomputed, so only the point is converted and uploaded. Falls back to
+    dmat_cached if cupy is not installed.
+
+    Parameters
+    ----------
+        lons_rad : cupy array
+            Longitudes in radians.
+        lats_rad : cupy array
+            Latitudes in radians.
+        cos_lats : cupy array
+            Cosines of lats_rad.
+        lon : float
+            Longitude of point in decimal degrees.
+        lat : float
+            Latitude of point in decimal degrees.
+        R : float
+            Earth's radius in km.
+        asnumpy : bool, optional
+            Copy the result back to the host. If False, a cupy array is
+            returned which stays on the device for further processing.
+
+    Returns
+    -------
+        d : numpy or cupy array
+            Distances in km, with the same shape as lons_rad and lats_rad.
+    """
+
+    if cp is None:
+        return dmat_cached(lons_rad, lats_rad, cos_lats, lon, lat, R)
+
+    lon_rad = np.deg2rad(np.asarray(lon, dtype=np.float64).reshape(1))
+    lat_rad = np.deg2rad(np.asarray(lat, dtype=np.float64).reshape(1))
+    out = _haversine_gpu(lons_rad.ravel(), lats_rad.ravel(), cos_lats.ravel(),
+                         cp.asarray(lon_rad), cp.asarray(lat_rad),
+                         cp.asarray(np.cos(lat_rad)), R)
+    out = out.reshape(lons_rad.shape)
+    return cp.asnumpy(out) if asnumpy else out
+
+
+def _haversine_gpu(lons1_rad, lats1_rad, cos_lats1, lons2_rad, lats2_rad,
+                   cos_lats2, R):
+    """Launch the haversine kernel on 1d device arrays in radians, returning
+    the (n, m) distance matrix on the device."""
+
+    n, m = lons1_rad.size, lons2_rad.size
+    out = cp.empty((n, m), dtype=cp.float64)
+    threads = 256
+    blocks = max((n*m + threads - 1)//threads, 1)
+    _haversine_kernel((blocks,), (threads,),
+                      (lons1_rad, lats1_rad, cos_lats1,
+                       lons2_rad, lats2_rad, cos_lats2,
+                       np.int64(n), np.int64(m), np.float64(R), out))
+    return out
@@ -6,17 +6,65 @@ Class to generate a quadtree-based Uniform Resolution Grid (URG) at arbitrary
 resolutions and to perform simple operations.
 """
 
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import cached_property
+
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import shapely as shp
+import xarray as xr
 from .qtree import QTree
-from .distance import dmat
+from .distance import dmat_cached, dmat_gpu_cached, dmat_mas
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 
 # Authalic radius of Earth in kilometres
 R = 6371.007
 
+# Number of quadcell polygons constructed at a time
+_POLYGON_BLOCK = 65536
+
+# Minimum number of candidate cells per apply_mask task, so that parsing and
+# preparing geometries in each task is amortised over enough tests
+_MIN_TASK_CELLS = 8192
+
+
+def _bounded_centroids(extent, bounds, res_mas, mas_per_degree):
+    """Centroids in milliarcseconds of the global grid cells along one axis
+    which lie within bounds, without generating the whole global axis.
+
+    Parameters
+    ----------
+    extent : int
+        Half-width of the global axis in decimal degrees, i.e. 180 or 90.
+    bounds : (float, float)
+        Bounds in decimal degrees.
+    res_mas : int
+        Grid resolution in milliarcseconds.
+    mas_per_degree : int
+        Milliarcseconds per degree.
+
+    Returns
+    -------
+    centroids : ndarray
+        Array of centroids in milliarcseconds.
+    """
+
+    n = 2*extent*mas_per_degree//res_mas
+    origin = -extent*mas_per_degree + res_mas//2
+    lo, hi = int(bounds[0]*mas_per_degree), int(bounds[1]*mas_per_degree)
+
+    # Indices of the first and last global centroids within the bounds
+    i0 = max(-((origin - lo)//res_mas), 0)
+    i1 = min((hi - origin)//res_mas, n-1)
+    return origin + np.arange(i0, max(i1+1, i0))*res_mas
+
 
 class QuadGrid():
     def __init__(self, res, lon_bounds=(-180,180), lat_bounds=(-90,90)):
@@ -39,99 +87,304 @@ class QuadGrid():
         self.lon_bounds = lon_bounds
         self.lat_bounds = lat_bounds
 
-        # Global centroid lons and lats in milliarcseconds
-        dlons = np.arange(360*self.mas_per_degree//self.res_mas)*self.res_mas
-        dlats = np.arange(180*self.mas_per_degree//self.res_mas)*self.res_mas
-        _lons = -180*self.mas_per_degree + self.res_mas//2 + dlons
-        _lats = -90*self.mas_per_degree + self.res_mas//2 + dlats
-
-        # Apply bounds and create object attributes
-        self._lons = _lons[(_lons>=int(lon_bounds[0]*self.mas_per_degree)) &
-                           (_lons<=int(lon_bounds[1]*self.mas_per_degree))]
-        self._lats = _lats[(_lats>=int(lat_bounds[0]*self.mas_per_degree)) &
-                           (_lats<=int(lat_bounds[1]*self.mas_per_degree))]
-
-        # Make mesh, ravel and create object attributes
-        _lons_2d, _lats_2d = np.meshgrid(self._lons, self._lats, indexing='xy')
-        self._lons_2d, self._lats_2d = _lons_2d.ravel(), _lats_2d.ravel()
+        # Centroid lons and lats in milliarcseconds within the bounds
+        self._lons = _bounded_centroids(180, lon_bounds, self.res_mas,
+                                        self.mas_per_degree)
+        self._lats = _bounded_centroids(90, lat_bounds, self.res_mas,
+                                        self.mas_per_degree)
 
         # Create object attributes in decimal degrees for convenience
         self.lons = self._lons / self.mas_per_degree
         self.lats = self._lats / self.mas_per_degree
-        self.lons_2d = self._lons_2d / self.mas_per_degree
-        self.lats_2d = self._lats_2d / self.mas_per_degree
 
-        # Generate qids, initial mask and MultiIndex
-        self.qt = QTree(res, mas=True)
-        self.qids = self.qt.lls2qids(self.lons_2d, self.lats_2d)
-        self.base_mask = np.full(self.qids.shape, True, dtype=bool)
-        self.mix = pd.MultiIndex.from_arrays([self.lats_2d, self.lons_2d],
-                                             names=['lat','lon'])
+        # Device copies of centroids in radians and their latitude cosines,
+        # uploaded on first GPU distance query
+        self._d_lons_rad, self._d_lats_rad = None, None
+        self._d_cos_lats = None
 
-        # Approximate quadcell areas in km2 assuming spherical Earth.
-        # See: https://gis.stackexchange.com/questions/29734/
-        res_rad = np.deg2rad(self.res)
-        self.areas = (np.sin(np.deg2rad(self.lats_2d+self.res/2)) -
-                      np.sin(np.deg2rad(self.lats_2d-self.res/2)))*res_rad*R**2
-
-        # Create geopandas GeoDataFrame as the reference version of the grid
-        lons_1 = self.lons_2d + self.res/2
-        lats_1 = self.lats_2d + self.res/2
-        lons_0 = self.lons_2d - self.res/2
-        lats_0 = self.lats_2d - self.res/2
-        geoms = np.empty((self.lons_2d.size*4, 2), dtype=np.float64)
-        geoms[::4,0], geoms[::4,1] = lons_1, lats_1
-        geoms[1::4,0], geoms[1::4,1] = lons_0, lats_1
-        geoms[2::4,0], geoms[2::4,1] = lons_0, lats_0
-        geoms[3::4,0], geoms[3::4,1] = lons_1, lats_0
-        geoms = shp.polygons(geoms.reshape((self.lons_2d.size, 4, 2)))
-
-        self.grid = gpd.GeoDataFrame({'lat': self.lats_2d, 'lon': self.lons_2d,
-                                      'qid': self.qids, 'area': self.areas,
-                                      'mask': self.base_mask, 'res': self.res,
-                                      'geometry': geoms}, crs='epsg:4326')
+        # Quadtree for qid lookups. Everything derived from the full mesh of
+        # centroids is computed lazily, on first access, as cached properties
+        self.qt = QTree(res, mas=True)
 
     def __repr__(self):
         return f'QuadGrid({self.res}°) | ' \
                f'{self.lon_bounds[0]}°<=lon<={self.lon_bounds[1]}° | ' \
                f'{self.lat_bounds[0]}°<=lat<={self.lat_bounds[1]}°'
 
-    def apply_mask(self, gdf, from_base=True):
-        """Create an intersection boolean mask from another GeoDataFrame."""
+    @cached_property
+    def _lons_2d(self):
+        """Raveled mesh of centroid lons in milliarcseconds."""
+        return np.tile(self._lons, self._lats.size)
+
+    @cached_property
+    def _lats_2d(self):
+        """Raveled mesh of centroid lats in milliarcseconds."""
+        return np.repeat(self._lats, self._lons.size)
+
+    @cached_property
+    def lons_2d(self):
+        """Raveled mesh of centroid lons in decimal degrees."""
+        return self._lons_2d / self.mas_per_degree
+
+    @cached_property
+    def lats_2d(self):
+        """Raveled mesh of centroid lats in decimal degrees."""
+        return self._lats_2d / self.mas_per_degree
+
+    @cached_property
+    def _lons_rad(self):
+        """Centroid lons in radians, cached for repeated distance queries."""
+        return np.deg2rad(self.lons_2d)
+
+    @cached_property
+    def _lats_rad(self):
+        """Centroid lats in radians, cached for repeated distance queries."""
+        return np.deg2rad(self.lats_2d)
+
+    @cached_property
+    def _cos_lats(self):
+        """Cosines of centroid lats, cached for repeated distance queries."""
+        return np.cos(self._lats_rad)
+
+    @cached_property
+    def _cos_lats_f32(self):
+        """float32 cosines of centroid lats, cached for repeated single
+        precision distance queries. Built per row, as they only depend on
+        latitude.
+        """
+        cos_lats = np.cos(np.deg2rad(self.lats)).astype(np.float32)
+        return np.repeat(cos_lats, self.lons.size)
+
+    @cached_property
+    def qids(self):
+        """Quadcell qids."""
+        return self.qt.lls2qids(self.lons_2d, self.lats_2d)
+
+    @cached_property
+    def base_mask(self):
+        """Initial mask including all quadcells."""
+        return np.full(self.lats.size*self.lons.size, True, dtype=bool)
+
+    @cached_property
+    def mix(self):
+        """MultiIndex of quadcell centroid (lat, lon) pairs."""
+
+        # Build directly from codes into the sorted 1d lats and lons, rather
+        # than factorising the full raveled mesh
+        nlat, nlon = self.lats.size, self.lons.size
+        return pd.MultiIndex(levels=[self.lats, self.lons],
+                             codes=[np.repeat(np.arange(nlat), nlon),
+                                    np.tile(np.arange(nlon), nlat)],
+                             names=['lat','lon'], verify_integrity=False)
+
+    @cached_property
+    def _areas_1d(self):
+        """Approximate quadcell areas in km2 assuming spherical Earth, for
+        each row of the grid, since areas only depend on latitude.
+        See: https://gis.stackexchange.com/questions/29734/
+        """
+
+        # Adjacent rows share an edge, so only take sines of each edge once
+        res_rad = np.deg2rad(self.res)
+        edges = np.r_[self.lats - self.res/2, self.lats[-1:] + self.res/2]
+        return np.diff(np.sin(np.deg2rad(edges)))*res_rad*R**2
+
+    @cached_property
+    def areas(self):
+        """Approximate quadcell areas in km2 assuming spherical Earth."""
+        return np.repeat(self._areas_1d, self.lons.size)
+
+    @cached_property
+    def _mask(self):
+        """Storage for the current quadcell mask."""
+        return self.base_mask.copy()
+
+    @property
+    def mask(self):
+        """Current quadcell mask, initially the base mask. This is the only
+        copy of the mask, and may be edited in place or assigned to. The
+        'mask' column of grid is derived from it whenever grid is accessed,
+        so edits made directly to that column are overwritten.
+        """
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        n_cells = self.lons.size*self.lats.size
+        if mask.size != n_cells:
+            raise ValueError(f'mask has {mask.size} elements, '
+                             f'expected {n_cells}')
+        self._mask = mask.ravel().copy()
+
+    @property
+    def grid(self):
+        """geopandas GeoDataFrame as the reference version of the grid, with
+        its 'mask' column refreshed from mask."""
+        grid = self._grid
+        grid['mask'] = self._mask.copy()
+        return grid
+
+    @cached_property
+    def _grid(self):
+        """Grid GeoDataFrame, built once on first access to grid."""
+
+        # Build in blocks of cells to bound the size of the corner buffer
+        geoms = np.empty(self.lons_2d.size, dtype=object)
+        for i0 in range(0, self.lons_2d.size, _POLYGON_BLOCK):
+            sl = slice(i0, i0+_POLYGON_BLOCK)
+            geoms[sl] = self._polygons(sl)
+
+        return gpd.GeoDataFrame({'lat': self.lats_2d, 'lon': self.lons_2d,
+                                 'qid': self.qids, 'area': self.areas,
+                                 'mask': self._mask, 'res': self.res,
+                                 'geometry': geoms}, crs='epsg:4326')
+
+    def _polygons(self, cells):
+        """Quadcell polygons for an index array or slice of the mesh."""
+
+        # Take centroids from the 1d axes, so the raveled mesh is never built
+        nlon = self.lons.size
+        if isinstance(cells, slice):
+            cells = np.arange(*cells.indices(nlon*self.lats.size))
+        centroids = np.column_stack([self.lons[cells % nlon],
+                                     self.lats[cells // nlon]])
+
+        # Corners are offsets from centroids, anticlockwise from top-right
+        offsets = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]]) * self.res/2
+        return shp.polygons(centroids[:, None, :] + offsets)
+
+    def apply_mask(self, gdf, from_base=True, n_threads=None):
+        """Create an intersection boolean mask from another GeoDataFrame.
+        Intersection tests are run in blocks on n_threads threads, which
+        defaults to the number of CPUs.
+        """
 
         # Check CRS is EPSG:4326
         if gdf.crs != 'epsg:4326':
             gdf = gdf.to_crs('epsg:4326')
 
-        # Do the spatial join
-        grid_mask = gpd.sjoin(self.grid, gdf[['geometry']], how='left'
-                              ).drop_duplicates('qid')
+        # Reuse the grid polygons if they exist, otherwise only build the
+        # polygons of candidate cells, so the grid is never materialised here
+        polys = None
+        if '_grid' in vars(self):
+            polys = np.asarray(self._grid.geometry)
+
+        def intersects(task):
+            # Prepared geometries should not be shared between threads, so
+            # each task parses and prepares its own copy of each geometry
+            hits = []
+            for wkb, cells in task:
+                geom = shp.from_wkb(wkb)
+                shp.prepare(geom)
+                for k in range(0, cells.size, _POLYGON_BLOCK):
+                    block = cells[k:k+_POLYGON_BLOCK]
+                    if polys is not None:
+                        hits.append(block[shp.intersects(geom, polys[block])])
+                    else:
+                        hits.append(block[shp.intersects(
+                            geom, self._polygons(block))])
+            return hits
+
+        # Find quadcells intersecting each geometry, only testing those cells
+        # inside its bounding box, which are located directly on the grid
+        nlon = self.lons.size
+        lons_0, lons_1 = self.lons - self.res/2, self.lons + self.res/2
+        lats_0, lats_1 = self.lats - self.res/2, self.lats + self.res/2
+        hit = np.zeros(nlon*self.lats.size, dtype=bool)
+        n_threads = n_threads or os.cpu_count() or 1
+
+        def collect(pending, limit):
+            # Mark hits as tasks finish, until at most limit are pending, so
+            # that candidates and results are not all held in memory at once
+            while len(pending) > limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    for cells in future.result():
+                        hit[cells] = True
+
+        with ThreadPoolExecutor(n_threads) as executor:
+            pending, task, task_cells = set(), [], 0
+            for geom in gdf.geometry:
+                if geom is None or geom.is_empty:
+                    continue
+                minx, miny, maxx, maxy = geom.bounds
+                j0 = np.searchsorted(lons_1, minx)
+                j1 = np.searchsorted(lons_0, maxx, side='right')
+                i0 = np.searchsorted(lats_1, miny)
+                i1 = np.searchsorted(lats_0, maxy, side='right')
+                if j0 >= j1 or i0 >= i1:
+                    continue
+                cells = (np.arange(i0, i1)[:, None]*nlon +
+                         np.arange(j0, j1)).ravel()
+
+                # Split large geometries across threads, and batch small ones
+                # together, so that every task tests enough cells
+                wkb = shp.to_wkb(geom)
+                size = max(-(-cells.size//n_threads), _MIN_TASK_CELLS)
+                for k in range(0, cells.size, size):
+                    task.append((wkb, cells[k:k+size]))
+                    task_cells += task[-1][1].size
+                    if task_cells >= _MIN_TASK_CELLS:
+                        pending.add(executor.submit(intersects, task))
+                        task, task_cells = [], 0
+                        collect(pending, 2*n_threads)
+            if task:
+                pending.add(executor.submit(intersects, task))
+            collect(pending, 0)
 
         # Determine the reference mask - if from_base, apply new mask to base,
-        # otherwise, apply the new mask to the current mask
+        # otherwise, apply the new mask to the current mask, in place
         if from_base:
-            ref_mask = grid_mask['mask']
+            np.logical_and(self.base_mask, hit, out=self._mask)
         else:
-            ref_mask = grid_mask
-        grid_mask['mask'] = ref_mask & ~grid_mask['index_right'].isna()
-        self.grid = grid_mask.drop('index_right', axis=1)
+            self._mask &= hit
 
     def query(self, lons, lats):
         """QuadcellID lookup."""
         return self.qt.lls2qids(np.atleast_1d(lons), np.atleast_1d(lats))
 
-    def distance(self, lon, lat):
-        """Distance matrix in km between a single point and all quadcells."""
-        return pd.Series(dmat(self.lons_2d, self.lats_2d, lon, lat, R).ravel(),
-                         index=self.mix, name=f'distance_km')
+    def distance(self, lon, lat, gpu=False, single=False):
+        """Distance matrix in km between a single point and all quadcells.
+        If gpu is True and cupy is installed, distances are computed on the GPU.
+        If single is True, distances are computed in single precision from
+        the milliarcsecond centroids, which halves the size of the result
+        and of the peak memory used.
+        """
+
+        if gpu and cp is not None:
+            if self._d_lons_rad is None:
+                self._d_lons_rad = cp.asarray(self._lons_rad)
+                self._d_lats_rad = cp.asarray(self._lats_rad)
+                self._d_cos_lats = cp.asarray(self._cos_lats)
+            d = dmat_gpu_cached(self._d_lons_rad, self._d_lats_rad,
+                                self._d_cos_lats, lon, lat, R)
+        elif single:
+            lon_mas, lat_mas = (
+                int(np.rint(np.asarray(x, dtype=np.float64).squeeze()
+                            * self.mas_per_degree)) for x in (lon, lat))
+            d = dmat_mas(self._lons_2d, self._lats_2d, self._cos_lats_f32,
+                         lon_mas, lat_mas, R)
+        else:
+            d = dmat_cached(self._lons_rad, self._lats_rad, self._cos_lats,
+                            lon, lat, R)
+        return pd.Series(d, index=self.mix, name=f'distance_km')
 
     def to_xarray(self, masked=True):
-        # Create xarray Dataset
+        """Convert to xarray Dataset."""
+
+        # Cells are stored in row-major (lat, lon) order, so every column
+        # can be reshaped directly onto the 1d lats and lons. The polygons
+        # are not needed, so avoid building the grid if it does not exist
         attrs = {'Resolution': f'{self.res}°', 'Area units': 'km2'}
-        df = self.grid.drop('geometry', axis=1
-                            ).set_index(['lat','lon']).sort_index()
-        return df.to_xarray().reindex(lon=self.lons, lat=self.lats,
-                                      method='nearest').assign_attrs(**attrs)
+        shape = (self.lats.size, self.lons.size)
+        data = {'qid': self.qids, 'area': self.areas, 'mask': self.mask.copy(),
+                'res': np.full(shape, self.res)}
+        return xr.Dataset({k: (('lat','lon'), v.reshape(shape))
+                           for k, v in data.items()},
+                          coords={'lat': self.lats, 'lon': self.lons},
+                          attrs=attrs)
 
     def to_geojson(self):
         """Convert to GeoJSON."""
@@ -13,10 +13,127 @@ longitudes must be defined from -180 to 180 degrees. Objects have four methods:
 From v0.2.0, robust to edge-case floating point round-off errors by working
 in milliarcseconds. Pre-v0.2.0 functions are still available in the package
 namespace, but it is recommended to use the QTree class in future.
+
+If numba is installed, the array methods dispatch to JIT-compiled kernels
+which run in parallel over points; otherwise the pure numpy versions are used.
 """
 
+from functools import lru_cache
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+# Deepest tree for which QTree tabulates qid contributions, giving two tables
+# of 2**(i_max+1) int64s, i.e. 1 MB each at most
+_LUT_MAX_LEVEL = 16
+
+# Signs of the lon and lat steps from parent to child centroid, by quadrant
+_SIGN_LUT = ((1, 1), (-1, 1), (-1, -1), (1, -1))
+
+# Quadrant codes indexed by whether a point is top, then right, of the origin
+_QUAD_LUT = ((2, 3), (1, 0))
+
+
+def _spread_bits(x):
+    """Spread the lower 32 bits of x so that bit i moves to bit 2i.
+
+    Works on python ints as well as uint64 arrays, using the standard
+    shift-and-mask sequence for interleaving Morton codes.
+    """
+
+    x = x & 0x00000000FFFFFFFF
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+    return x
+
+
+def _compact_bits(x):
+    """Compact the even bits of x so that bit 2i moves to bit i.
+
+    Inverse of _spread_bits, for python ints as well as uint64 arrays.
+    """
+
+    x = x & 0x5555555555555555
+    x = (x | (x >> 1)) & 0x3333333333333333
+    x = (x | (x >> 2)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x >> 4)) & 0x00FF00FF00FF00FF
+    x = (x | (x >> 8)) & 0x0000FFFF0000FFFF
+    x = (x | (x >> 16)) & 0x00000000FFFFFFFF
+    return x
+
+
+@lru_cache(maxsize=None)
+def _qid_luts(i_max):
+    """Tables of the contributions of lon and lat cell offsets to the qid.
+
+    As qids are Morton codes of (top xor right, not top), the lat table holds
+    the odd bits and the even bits of the xor, so that
+    qid = lut_lat[v] ^ lut_lon[u]. The tables are built on first use by the
+    numpy fallback of QTree.lls2qids, and shared between trees of one depth.
+    """
+
+    offsets = np.arange(2 << i_max, dtype=np.uint64)
+    lut_lon = _spread_bits(offsets).astype(np.int64)
+    lut_lat = ((_spread_bits(~offsets & offsets[-1]) << 1) |
+               _spread_bits(offsets)).astype(np.int64)
+    lut_lon.flags.writeable = False
+    lut_lat.flags.writeable = False
+    return lut_lon, lut_lat
+
+
+if njit is not None:
+    _spread_bits_jit = njit(cache=True)(_spread_bits)
+    _compact_bits_jit = njit(cache=True)(_compact_bits)
+
+    @njit(parallel=True, cache=True)
+    def _lls2qids_kernel(lons, lats, res, res_mas, i_max, mas,
+                         mas_per_degree):
+        """Numba kernel for QTree.lls2qids, interleaving cell offsets."""
+
+        n = np.int64(1) << i_max
+        qids = np.empty(lons.size, dtype=np.int64)
+        for p in prange(lons.size):
+            # Discretise lon and lat exactly as in QTree.lls2qids
+            if not mas:
+                lon_int = np.int64(np.ceil(lons[p]/res))
+                lat_int = np.int64(np.ceil(lats[p]/res))
+            else:
+                lon_int = np.int64(np.round(lons[p]*mas_per_degree))
+                lat_int = np.int64(np.round(lats[p]*mas_per_degree))
+                lon_int = -(-lon_int // res_mas)
+                lat_int = -(-lat_int // res_mas)
+
+            u = min(max(lon_int + (n-1), 0), 2*n-1)
+            v = min(max(lat_int + (n-1), 0), 2*n-1)
+            qids[p] = ((_spread_bits_jit(~v & (2*n-1)) << 1) |
+                       _spread_bits_jit(u ^ v))
+        return qids
+
+    @njit(parallel=True, cache=True)
+    def _qids2lls_kernel(qids, res, i_max):
+        """Numba kernel for QTree.qids2lls, de-interleaving each qid."""
+
+        n = np.int64(1) << i_max
+        lons = np.empty(qids.size, dtype=np.float64)
+        lats = np.empty(qids.size, dtype=np.float64)
+        for p in prange(qids.size):
+            v = ~_compact_bits_jit(qids[p] >> 1) & (2*n-1)
+            u = _compact_bits_jit(qids[p]) ^ v
+            lons[p] = (2*(u-n) + 1) * res/2
+            lats[p] = (2*(v-n) + 1) * res/2
+        return lons, lats
+else:
+    _lls2qids_kernel = None
+    _qids2lls_kernel = None
+
 
 class QTree():
     def __init__(self, res, mas=False):
@@ -36,6 +153,10 @@ class QTree():
         # Determine number of levels given target resolution
         self.i_max = int(np.ceil(np.log2(180/self.res)))
 
+        # Quadrant weight of each level in the qid, deepest-first
+        self._deltas = tuple(1 << 2*(self.i_max-i)
+                             for i in range(self.i_max+1))
+
     def __repr__(self):
         mas_str = '' if not self.mas else '[mas]'
         return f'QuadTree({self.res}°{mas_str})'
@@ -72,27 +193,15 @@ class QTree():
         # Initialise origin and qid
         origin_lon_int, origin_lat_int, qid = 0, 0, 0
 
-        for i in range(self.i_max+1):
-            delta = 4**(self.i_max-i)
+        for delta in self._deltas:
             shift >>= 1
             right = lon_int > origin_lon_int
             top = lat_int > origin_lat_int
-            if top and right:
-                # Do nothing to the qid
-                origin_lon_int += shift
-                origin_lat_int += shift
-            elif top and not right:
-                qid += delta
-                origin_lon_int -= shift
-                origin_lat_int += shift
-            elif not top and not right:
-                qid += 2*delta
-                origin_lon_int -= shift
-                origin_lat_int -= shift
-            else:
-                qid += 3*delta
-                origin_lon_int += shift
-                origin_lat_int -= shift
+            quad = _QUAD_LUT[top][right]
+            sx, sy = _SIGN_LUT[quad]
+            qid += quad * delta
+            origin_lon_int += sx * shift
+            origin_lat_int += sy * shift
 
         if verbose:
             if self.mas:
@@ -128,19 +237,16 @@ class QTree():
         lon_int, lat_int, shift = 0, 0, 1
 
         for i in range(self.i_max+1):
+            # Once the qid is exhausted every remaining digit is quadrant 0,
+            # so add the remaining shifts, which sum to 2**(i_max+1) - shift
+            if not qid:
+                lon_int += (2 << self.i_max) - shift
+                lat_int += (2 << self.i_max) - shift
+                break
             qid, mod = divmod(qid, 4)
-            if mod == 0:
-                lon_int += shift
-                lat_int += shift
-            elif mod == 1:
-                lon_int -= shift
-                lat_int += shift
-            elif mod == 2:
-                lon_int -= shift
-                lat_int -= shift
-            else:
-                lon_int += shift
-                lat_int -= shift
+            sx, sy = _SIGN_LUT[mod]
+            lon_int += sx * shift
+            lat_int += sy * shift
             shift <<= 1
 
         lon = lon_int * self.res/2
@@ -163,48 +269,39 @@ class QTree():
             Array of qids.
         """
 
+        if _lls2qids_kernel is not None:
+            lons = np.asarray(lons, dtype=np.float64)
+            lats = np.asarray(lats, dtype=np.float64)
+            qids = _lls2qids_kernel(lons.ravel(), lats.ravel(), self.res,
+                                    self.res_mas, self.i_max, self.mas,
+                                    self.mas_per_degree)
+            return qids.reshape(lons.shape)
+
         # Discretise lons and lats to integer numbers of cell widths
         if not self.mas:
             lons_int = np.ceil(lons/self.res).astype(np.int64)
             lats_int = np.ceil(lats/self.res).astype(np.int64)
-            shift = 1 << self.i_max
-        # Convert lons and lats to milliarcseconds
+        # Convert lons and lats to milliarcseconds, then to cell widths
         else:
             lons_int = np.round(lons*self.mas_per_degree).astype(np.int64)
             lats_int = np.round(lats*self.mas_per_degree).astype(np.int64)
-            shift = self.res_mas << self.i_max
-
-        # Initialise qid array, origins and shift
-        qids = np.zeros_like(lons, dtype=np.int64)
-        origin_lons_int = np.zeros_like(lons, dtype=np.int64)
-        origin_lats_int = np.zeros_like(lats, dtype=np.int64)
-
-        for i in range(self.i_max+1):
-            delta = 4**(self.i_max-i)
-            shift >>= 1
-            right = lons_int > origin_lons_int
-            top = lats_int > origin_lats_int
-
-            # Define disjoint masks by quadrant for all points in the arrays
-            mask0 = top & right
-            mask1 = top & ~right
-            mask2 = ~top & ~right
-            mask3 = ~top & right
-
-            # Shift origins by quadrant
-            # Do nothing to the qids for mask0
-            origin_lons_int[mask0] += shift
-            origin_lats_int[mask0] += shift
-            qids[mask1] = qids[mask1] + delta
-            origin_lons_int[mask1] -= shift
-            origin_lats_int[mask1] += shift
-            qids[mask2] = qids[mask2] + 2*delta
-            origin_lons_int[mask2] -= shift
-            origin_lats_int[mask2] -= shift
-            qids[mask3] = qids[mask3] + 3*delta
-            origin_lons_int[mask3] += shift
-            origin_lats_int[mask3] -= shift
-        return qids
+            lons_int = -(-lons_int // self.res_mas)
+            lats_int = -(-lats_int // self.res_mas)
+
+        # Offset cells from the bottom-left corner of the tree, so that bit
+        # i_max-i of each offset is 1 for right/top at level i
+        n = 1 << self.i_max
+        us = np.clip(lons_int + (n-1), 0, 2*n-1)
+        vs = np.clip(lats_int + (n-1), 0, 2*n-1)
+        if self.i_max <= _LUT_MAX_LEVEL:
+            lut_lon, lut_lat = _qid_luts(self.i_max)
+            return lut_lat[vs] ^ lut_lon[us]
+
+        # Quadrant codes 0-3 are the bit pairs (not top, top xor right), so
+        # qids are Morton codes of (top xor right, not top)
+        us, vs = us.astype(np.uint64), vs.astype(np.uint64)
+        qids = (_spread_bits(~vs & (2*n-1)) << 1) | _spread_bits(us ^ vs)
+        return qids.astype(np.int64)
 
     def qids2lls(self, qids):
         """Converts array of qids to arrays of quadcell centroids lons and lats.
@@ -222,26 +319,19 @@ class QTree():
             Array of quadcell centroid latitudes in decimal degrees.
         """
 
-        # Initialise integer lon and lat arrays
-        lons_int = np.zeros_like(qids, dtype=np.int64)
-        lats_int = np.zeros_like(qids, dtype=np.int64)
-        shift = 1
-
-        for i in range(self.i_max+1):
-            qids, mods = np.divmod(qids, 4)
-            mask0 = mods == 0
-            mask1 = mods == 1
-            mask2 = mods == 2
-            mask3 = mods == 3
-            lons_int[mask0] += shift
-            lats_int[mask0] += shift
-            lons_int[mask1] -= shift
-            lats_int[mask1] += shift
-            lons_int[mask2] -= shift
-            lats_int[mask2] -= shift
-            lons_int[mask3] += shift
-            lats_int[mask3] -= shift
-            shift <<= 1
+        if _qids2lls_kernel is not None:
+            qids = np.asarray(qids, dtype=np.int64)
+            lons, lats = _qids2lls_kernel(qids.ravel(), self.res, self.i_max)
+            return lons.reshape(qids.shape), lats.reshape(qids.shape)
+
+        # De-interleave the qids into cell offsets from the bottom-left corner
+        # of the tree, then into odd multiples of half a cell width
+        qids = np.asarray(qids, dtype=np.int64).astype(np.uint64)
+        n = 1 << self.i_max
+        vs = ~_compact_bits(qids >> np.uint64(1)) & np.uint64(2*n-1)
+        us = _compact_bits(qids) ^ vs
+        lons_int = 2*(us.astype(np.int64) - n) + 1
+        lats_int = 2*(vs.astype(np.int64) - n) + 1
 
         lons = lons_int * self.res/2
         lats = lats_int * self.res/2
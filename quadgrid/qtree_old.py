@@ -9,6 +9,7 @@ must be defined from -180 to 180 degrees.
     qid2ll - converts a single qid to a (lon, lat) pair
     lls2qids - converts numpy arrays of lons and lats to an array of qids
     qids2lls - converts a numpy array of qids to arrays of lons and lats
+    compile_ll2qid - specialises ll2qid to a fixed target resolution
     
 The functions all start by classifying a (lon, lat) point into one of the 
 main quadrants on the Earth's surface. The origin (initially {0,0}) is then 
@@ -18,9 +19,116 @@ child quadrants. The process continues recursively until the target resolution
 is reached. The initial resolution is chosen such that it is:
   (a) larger by a factor of a power of 2 than the grid resolution
   (b) >=180 degrees
+
+Equivalently, the bits of a point's integer cell offsets from the corner of
+the top-level quadrants give its child quadrant at each level, so qids are
+computed directly by quantising coordinates and interleaving these bits.
+If numba is installed, all four functions use JIT-compiled kernels, which
+run in parallel for large arrays.
 """
 
+import math
+from functools import lru_cache
+
 import numpy as np
+from .qtree import _spread_bits, _compact_bits
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+# Arrays smaller than this are converted by the serial numba kernels, as
+# waking the thread pool costs more than it saves
+_PARALLEL_MIN_SIZE = 8192
+
+
+@lru_cache(maxsize=None)
+def _n_levels(res_target):
+    """Number of levels i_max below the top-level quadrants.
+
+    This is the smallest i_max with res_target * 2**i_max >= 180. Scaling by
+    powers of 2 is exact, so unlike ceil(log2(180/res_target)) the count has
+    no rounding hazard, and it is cached per resolution.
+    """
+
+    if not (res_target > 0 and math.isfinite(res_target)):
+        raise ValueError(f'res_target must be positive and finite, '
+                         f'got {res_target}')
+
+    i_max = 0
+    while res_target * (1 << i_max) < 180:
+        i_max += 1
+    return i_max
+
+
+if njit is not None:
+    _spread_bits_jit = njit(cache=True)(_spread_bits)
+    _compact_bits_jit = njit(cache=True)(_compact_bits)
+
+    @njit(cache=True)
+    def _ll2qid_kernel(lon, lat, res_target, i_max):
+        """Numba kernel for ll2qid, without verbose output."""
+
+        n = 1 << i_max
+        u = np.int64(min(max(np.floor(lon/res_target) + n, 0), 2*n-1))
+        v = np.int64(min(max(np.floor(lat/res_target) + n, 0), 2*n-1))
+        return (_spread_bits_jit(~v & (2*n-1)) << 1) | _spread_bits_jit(u ^ v)
+
+    @njit(cache=True)
+    def _qid2ll_kernel(qid, res_target, i_max):
+        """Numba kernel for qid2ll, without verbose output."""
+
+        n = 1 << i_max
+        v = ~_compact_bits_jit(qid >> 1) & (2*n-1)
+        u = _compact_bits_jit(qid) ^ v
+        return (u-n+0.5)*res_target, (v-n+0.5)*res_target
+
+    @njit(cache=True)
+    def _lls2qids_serial(lons, lats, res_target, i_max):
+        """Serial numba kernel for lls2qids, for small arrays."""
+
+        qids = np.empty(lons.size, dtype=np.int64)
+        for p in range(lons.size):
+            qids[p] = _ll2qid_kernel(lons[p], lats[p], res_target, i_max)
+        return qids
+
+    @njit(cache=True)
+    def _qids2lls_serial(qids, res_target, i_max):
+        """Serial numba kernel for qids2lls, for small arrays."""
+
+        lons = np.empty(qids.size, dtype=np.float64)
+        lats = np.empty(qids.size, dtype=np.float64)
+        for p in range(qids.size):
+            lons[p], lats[p] = _qid2ll_kernel(qids[p], res_target, i_max)
+        return lons, lats
+
+    @njit(parallel=True, cache=True)
+    def _lls2qids_kernel(lons, lats, res_target, i_max):
+        """Numba kernel for lls2qids, running _ll2qid_kernel per point."""
+
+        qids = np.empty(lons.size, dtype=np.int64)
+        for p in prange(lons.size):
+            qids[p] = _ll2qid_kernel(lons[p], lats[p], res_target, i_max)
+        return qids
+
+    @njit(parallel=True, cache=True)
+    def _qids2lls_kernel(qids, res_target, i_max):
+        """Numba kernel for qids2lls, running _qid2ll_kernel per qid."""
+
+        lons = np.empty(qids.size, dtype=np.float64)
+        lats = np.empty(qids.size, dtype=np.float64)
+        for p in prange(qids.size):
+            lons[p], lats[p] = _qid2ll_kernel(qids[p], res_target, i_max)
+        return lons, lats
+else:
+    _ll2qid_kernel = None
+    _qid2ll_kernel = None
+    _lls2qids_kernel = None
+    _qids2lls_kernel = None
+    _lls2qids_serial = None
+    _qids2lls_serial = None
 
 
 def ll2qid(lon, lat, res_target, verbose=False):
@@ -41,39 +149,68 @@ def ll2qid(lon, lat, res_target, verbose=False):
             Quadcell qid.
     """
 
-    # Determine resolution of top-level quadrants, given target resolution
-    i_max = int(np.ceil(np.log2(180/res_target)))
-    res = res_target * 2**i_max
-
-    i, qid, origin_lon, origin_lat = 0, 0, 0, 0
-    while res >= res_target:
-        delta = 4**(i_max-i)
-        if lon >= origin_lon and lat >= origin_lat:
-            # Do nothing to the qid
-            origin_lon, origin_lat = (origin_lon+res/2, origin_lat+res/2)
-        elif lon < origin_lon and lat >= origin_lat:
-            qid = qid + delta
-            origin_lon, origin_lat = (origin_lon-res/2, origin_lat+res/2)
-        elif lon < origin_lon and lat < origin_lat:
-            qid = qid + 2*delta
-            origin_lon, origin_lat = (origin_lon-res/2, origin_lat-res/2)
-        elif lon >= origin_lon and lat < origin_lat:
-            qid = qid + 3*delta
-            origin_lon, origin_lat = (origin_lon+res/2, origin_lat-res/2)
-        else:
-            print(f'Error:\n lon: {lon}\n lat: {lat}')
-            return None
-
-        # Halve the resolution and update counter
-        res /= 2
-        i += 1
+    # Determine number of levels below top-level quadrants
+    i_max = _n_levels(res_target)
+    n = 1 << i_max
+
+    if np.isnan(lon) or np.isnan(lat):
+        print(f'Error:\n lon: {lon}\n lat: {lat}')
+        return None
+
+    if _ll2qid_kernel is not None and not verbose:
+        return int(_ll2qid_kernel(lon, lat, res_target, i_max))
+
+    # Quantise to integer cell offsets from the bottom-left corner of the
+    # top-level quadrants; bit i_max-i of each is 1 for right/top at level i
+    u = int(np.clip(np.floor(lon/res_target) + n, 0, 2*n-1))
+    v = int(np.clip(np.floor(lat/res_target) + n, 0, 2*n-1))
+
+    # Quadrant codes 0-3 are the bit pairs (not top, top xor right), so the
+    # qid is the Morton code of (top xor right, not top)
+    qid = (_spread_bits(~v & (2*n-1)) << 1) | _spread_bits(u ^ v)
 
     if verbose:
+        origin_lon, origin_lat = (u-n+0.5)*res_target, (v-n+0.5)*res_target
         print(f'({lon}, {lat}) -> {qid}')
-        print(f'Resolution={2*res} | centroid=({origin_lon}, {origin_lat})')
+        print(f'Resolution={res_target} | centroid=({origin_lon}, {origin_lat})')
     return qid
 
 
+def compile_ll2qid(res_target):
+    """Compiles a version of ll2qid specialised to one target resolution.
+
+    The number of levels and the offset bounds are baked into the returned
+    function as constants. If numba is installed it is JIT-compiled up front,
+    otherwise it is a plain python closure. Unlike ll2qid, it does not check
+    for NaNs or print verbose output, so lon and lat must be finite.
+
+    Parameters
+    ----------
+        res_target : float
+            Target resolution.
+
+    Returns
+    -------
+        ll2qid_fixed : callable
+            Function taking a quadcell centroid (lon, lat) and returning its
+            qid at resolution res_target.
+    """
+
+    i_max = _n_levels(res_target)
+    n = 1 << i_max
+    hi = 2*n - 1
+    spread_bits = _spread_bits_jit if njit is not None else _spread_bits
+
+    def ll2qid_fixed(lon, lat):
+        u = min(max(math.floor(lon/res_target) + n, 0), hi)
+        v = min(max(math.floor(lat/res_target) + n, 0), hi)
+        return (spread_bits(~v & hi) << 1) | spread_bits(u ^ v)
+
+    if njit is not None:
+        return njit('int64(float64, float64)')(ll2qid_fixed)
+    return ll2qid_fixed
+
+
 def qid2ll(qid, res_target, verbose=False):
     """Converts a single qid to the (lon, lat) of the centroid of the quadcell.
 
@@ -93,26 +230,21 @@ def qid2ll(qid, res_target, verbose=False):
 
     """
 
-    qid0, lon, lat, delta = qid*1, 0, 0, res_target/2
-
-    while delta <= 180:
-        qid, mod = divmod(qid, 4)
-        if mod == 0:
-            lon += delta
-            lat += delta
-        elif mod == 1:
-            lon -= delta
-            lat += delta
-        elif mod == 2:
-            lon -= delta
-            lat -= delta
-        elif mod == 3:
-            lon += delta
-            lat -= delta
-        delta *= 2
+    # Determine number of levels below top-level quadrants
+    i_max = _n_levels(res_target)
+    n = 1 << i_max
+
+    # De-interleave the qid into integer cell offsets from the bottom-left
+    # corner of the top-level quadrants, then convert to centroids
+    if _qid2ll_kernel is not None:
+        lon, lat = _qid2ll_kernel(qid, res_target, i_max)
+    else:
+        v = ~_compact_bits(qid >> 1) & (2*n-1)
+        u = _compact_bits(qid) ^ v
+        lon, lat = (u-n+0.5)*res_target, (v-n+0.5)*res_target
 
     if verbose:
-        print(f'{qid0} -> ({lon}, {lat})')
+        print(f'{qid} -> ({lon}, {lat})')
         print(f'Resolution={res_target}')
     return lon, lat
 
@@ -135,47 +267,27 @@ def lls2qids(lons, lats, res_target):
             1d ndarray of qids.
     """
 
-    # Determine resolution of top-level quadrants, given target resolution
-    i_max = int(np.ceil(np.log2(180/res_target)))
-    res = res_target * 2**i_max
+    # Determine number of levels below top-level quadrants
+    i_max = _n_levels(res_target)
+    n = 1 << i_max
 
-    i = 0
-    qids = np.zeros_like(lons, dtype=np.int64)
-    origin_lons = np.zeros_like(lons)
-    origin_lats = np.zeros_like(lats)
+    if _lls2qids_kernel is not None:
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        kernel = (_lls2qids_kernel if lons.size >= _PARALLEL_MIN_SIZE
+                  else _lls2qids_serial)
+        qids = kernel(lons.ravel(), lats.ravel(), res_target, i_max)
+        return qids.reshape(lons.shape)
 
-    while res >= res_target:
-        delta = 4**(i_max-i)
+    # Quantise to integer cell offsets from the bottom-left corner of the
+    # top-level quadrants; bit i_max-i of each is 1 for right/top at level i
+    us = np.clip(np.floor(lons/res_target) + n, 0, 2*n-1).astype(np.int64)
+    vs = np.clip(np.floor(lats/res_target) + n, 0, 2*n-1).astype(np.int64)
 
-        # Define disjoint masks by quadrant for all points in the arrays
-        mask0 = (lons >= origin_lons) & (lats >= origin_lats)
-        mask1 = (lons < origin_lons) & (lats >= origin_lats)
-        mask2 = (lons < origin_lons) & (lats < origin_lats)
-        mask3 = (lons >= origin_lons) & (lats < origin_lats)
+    # Quadrant codes 0-3 are the bit pairs (not top, top xor right), so the
+    # qids are Morton codes of (top xor right, not top)
+    return (_spread_bits(~vs & (2*n-1)) << 1) | _spread_bits(us ^ vs)
 
-        # Shift origins by quadrant
-        # Do nothing to the qids for mask0
-        origin_lons[mask0] = origin_lons[mask0] + res/2
-        origin_lats[mask0] = origin_lats[mask0] + res/2
-
-        qids[mask1] = qids[mask1] + delta
-        origin_lons[mask1] = origin_lons[mask1] - res/2
-        origin_lats[mask1] = origin_lats[mask1] + res/2
-
-        qids[mask2] = qids[mask2] + 2*delta
-        origin_lons[mask2] = origin_lons[mask2] - res/2
-        origin_lats[mask2] = origin_lats[mask2] - res/2
-
-        qids[mask3] = qids[mask3] + 3*delta
-        origin_lons[mask3] = origin_lons[mask3] + res/2
-        origin_lats[mask3] = origin_lats[mask3] - res/2
-
-        # Halve the resolution and update counter
-        res /= 2
-        i += 1
-
-    return qids
- 
 
 def qids2lls(qids, res_target):
     """Converts arrays of qids to (lon, lat) arrays of quadcell centroids.
@@ -195,28 +307,22 @@ def qids2lls(qids, res_target):
             1d ndarray of quadcell centroid latitudes in decimal degrees.
     """
 
-    qids0 = qids*1
-    lons = np.zeros_like(qids, dtype=np.float64)
-    lats = np.zeros_like(qids, dtype=np.float64)
-    delta = res_target/2
-
-    while delta <= 180:
-        qids, mods = np.divmod(qids, 4)
-
-        mask0 = mods == 0
-        mask1 = mods == 1
-        mask2 = mods == 2
-        mask3 = mods == 3
-
-        lons[mask0] += delta
-        lats[mask0] += delta
-        lons[mask1] -= delta
-        lats[mask1] += delta
-        lons[mask2] -= delta
-        lats[mask2] -= delta
-        lons[mask3] += delta
-        lats[mask3] -= delta
-
-        delta *= 2
-
+    # Determine number of levels below top-level quadrants
+    i_max = _n_levels(res_target)
+    n = 1 << i_max
+
+    if _qids2lls_kernel is not None:
+        qids = np.asarray(qids, dtype=np.int64)
+        kernel = (_qids2lls_kernel if qids.size >= _PARALLEL_MIN_SIZE
+                  else _qids2lls_serial)
+        lons, lats = kernel(qids.ravel(), res_target, i_max)
+        return lons.reshape(qids.shape), lats.reshape(qids.shape)
+
+    # De-interleave the qids into integer cell offsets from the bottom-left
+    # corner of the top-level quadrants, then convert to centroids. Every
+    # step returns a new array, so the input qids are left untouched
+    vs = ~_compact_bits(qids >> 1) & (2*n-1)
+    us = _compact_bits(qids) ^ vs
+    lons = (us - n + 0.5) * res_target
+    lats = (vs - n + 0.5) * res_target
     return lons, lats